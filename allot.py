@@ -1,16 +1,28 @@
 import subprocess
-from dataclasses import dataclass, asdict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 import os
 from pathlib import Path as P
 import re
 import time
+import base64
 from enum import IntEnum, auto
+from collections import deque
 import math
 from typing import Callable
 import shlex
+import selectors
 import json
 import logging
 import sys
+import ctypes
+import struct
+
+try:
+    import orjson # optional, faster saving and restoring of the cluster state
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger("allot")
 logger.setLevel(logging.DEBUG)
@@ -21,9 +33,43 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+class _RecordCounter(logging.Filter):
+
+    # counts the records the handler writes to stdout, the progress block is
+    # only redrawn in place when nothing was logged below it
+    def __init__(self) -> None:
+        super().__init__()
+        self.count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self.count += 1
+        return True
+
+_stdout_records = _RecordCounter()
+handler.addFilter(_stdout_records)
+
+
 PROGRESS_WIDTH = 50
 GLOBAL_TIMEOUT = 10
+MAX_CONCURRENT_POLLS = 32
 FILE_MODIFICATION_TIMEOUT = 2 * 60 * 60
+PROGRESS_TAIL_BYTES = 4096
+PROGRESS_TOKEN_MAX_BYTES = 64
+WATCH_INTERVAL = 5
+WATCH_COALESCE = 0.5 # seconds of further output collected after a change
+
+# progress is printed as \x02[current_step]/[total_steps]\x03, matched on raw bytes
+_PROG_START = b"\x02"
+_PROG_END = b"\x03"
+_PROG_RE = re.compile(re.escape(_PROG_START) + rb"(\d+)/(\d+)" + re.escape(_PROG_END))
+
+# printed by the persistent remote shell after each command, with its exit code
+_SHELL_DONE = b"__ALLOT_DONE__"
+
+# ssh connection multiplexing, one master connection per (user, host, port)
+SSH_CONTROL_DIR = P("~/.ssh/allot-cm").expanduser()
+SSH_CONTROL_PERSIST = 600
+SSH_MULTIPLEXING = os.environ.get("ALLOT_DISABLE_SSH_MUX", "") in ("", "0")
 
 
 class NodeStatus(IntEnum):
@@ -45,7 +91,63 @@ class ClusterStatus(IntEnum):
     FINISHED      = auto()
 
 
-@dataclass
+class _Inotify:
+
+    # from <sys/inotify.h>
+    IN_MODIFY      = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_CREATE      = 0x100
+    EVENT_HEADER   = struct.Struct("iIII") # wd, mask, cookie, len
+
+    def __init__(self) -> None:
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories: dict[int, str] = {}
+
+    @classmethod
+    def create(cls) -> "_Inotify | None":
+        try:
+            return cls()
+        except (OSError, AttributeError):
+            return None # not on linux
+
+    def add_watch(self, directory: P):
+        if str(directory) in self.directories.values():
+            return
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd >= 0:
+            self.directories[wd] = str(directory)
+
+    def wait(self, timeout: float) -> set[str]:
+        # paths of the files changed within `timeout` seconds
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.fd, selectors.EVENT_READ)
+            if len(selector.select(timeout)) == 0:
+                return set()
+        time.sleep(WATCH_COALESCE)
+        changed = set()
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buffer):
+                wd, _, _, name_len = self.EVENT_HEADER.unpack_from(buffer, offset)
+                offset += self.EVENT_HEADER.size
+                name = buffer[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if wd in self.directories:
+                    changed.add(os.path.join(self.directories[wd], os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+@dataclass(slots=True)
 class NodeTaskConfig:
     cpus_on_node: int
     job_name:     str
@@ -55,22 +157,51 @@ class NodeTaskConfig:
     node_id:      int  # [ 0   0] [ 1   1]
     proc_id:      int  # [ 0   1] [ 2   3]
 
+    def to_dict(self) -> dict:
+        return {
+            'cpus_on_node': self.cpus_on_node,
+            'job_name': self.job_name,
+            'node_name': self.node_name,
+            'output_dir': str(self.output_dir),
+            'local_id': self.local_id,
+            'node_id': self.node_id,
+            'proc_id': self.proc_id
+        }
+
     @classmethod
     def from_dict(cls, data: dict):
         data['output_dir'] = P(data['output_dir'])
         return cls(**data)
 
 
-@dataclass
+@dataclass(slots=True)
 class Task:
     command:      list[str]
     output_file:  P
     config:       NodeTaskConfig # should not be here, but is just for convenience
     status:       TaskStatus = TaskStatus.NOT_STARTED
     last_update:  int = 0
+    last_size:    int = 0 # with last_update, the output file as last read
     progress:     int = 0
     total:        int = 0
-    # add file pointer to seek large logs
+    file_offset:  int = 0 # output file is read incrementally from here
+    _joined:      str = field(init=False, repr=False, compare=False) # commands as script lines
+
+    def __post_init__(self):
+        self._joined = '\n'.join(self.command)
+
+    def to_dict(self) -> dict:
+        return {
+            'command': self.command,
+            'output_file': str(self.output_file),
+            'config': self.config.to_dict(),
+            'status': self.status.value,
+            'last_update': self.last_update,
+            'last_size': self.last_size,
+            'progress': self.progress,
+            'total': self.total,
+            'file_offset': self.file_offset
+        }
 
     @classmethod
     def from_dict(cls, data: dict):
@@ -85,137 +216,391 @@ class Task:
 
 class Node:
 
+    __slots__ = (
+        'name', 'address', 'shared_fs', 'nproc', 'status', 'status_process', 'tasks',
+        '__lock', '__shell', '__status_handlers', '__task_handlers',
+    )
+
     TIMEOUT = GLOBAL_TIMEOUT
+    __control_dir_created = False # shared by all nodes, made on first use
 
-    def __init__(self, name: str, address: str, tasks: list[Task] | None = None) -> None:
+    def __init__(self, name: str, address: str, tasks: list[Task] | None = None, shared_fs: bool = True) -> None:
         self.name = name
         self.address = address
+        self.shared_fs = shared_fs
         self.nproc = 0
         self.status = NodeStatus.UNINITIALISED
         self.status_process: subprocess.Popen | None = None
         self.tasks: list[Task] = tasks if tasks is not None else []
+        self.__lock = threading.RLock() # nodes are polled from worker threads
+        self.__shell: subprocess.Popen | None = None
+        # dispatch on the current status, one handler per state
+        self.__status_handlers: dict[NodeStatus, Callable[[dict[P, set[str]] | None], NodeStatus]] = {
+            NodeStatus.DOWN:          self.__status_down,
+            NodeStatus.UNINITIALISED: self.__status_uninitialised,
+            NodeStatus.CHECKING:      self.__status_checking,
+            NodeStatus.UP:            self.__status_up,
+        }
+        self.__task_handlers: dict[TaskStatus, Callable[[Task, int | None, bytes | None, int | None], TaskStatus]] = {
+            TaskStatus.NOT_STARTED:   self.__task_not_started,
+            TaskStatus.FINISHED:      self.__task_done,
+            TaskStatus.RUNNING_EARLY: self.__task_running_early,
+            TaskStatus.RUNNING:       self.__task_running,
+            TaskStatus.STALLED:       self.__task_done,
+        }
 
 
     def to_dict(self) -> dict:
-
-        def task_to_dict(task: Task):
-            task_dict = asdict(task)
-            print(task_dict)
-            task_dict['status'] = task_dict['status'].value
-            task_dict['output_file'] = str(task_dict['output_file'])
-            task_dict['config']['output_dir'] = str(task_dict['config']['output_dir'])
-            return task_dict
         return {
             'name': self.name,
             'address': self.address,
+            'shared_fs': self.shared_fs,
             'nproc': self.nproc,
             'status_process': None,
-            'tasks': [task_to_dict(task) for task in self.tasks]
+            'tasks': [task.to_dict() for task in self.tasks]
         }
 
 
     @classmethod
     def from_dict(cls, data: dict):
         tasks = [Task.from_dict(t) for t in data['tasks']]
-        obj: Node = cls(data['name'], data['address'], tasks)
+        obj: Node = cls(data['name'], data['address'], tasks, data.get('shared_fs', True))
         obj.update_and_get_status()
         return obj
 
 
     def assign_task(self, task: Task):
-        cmd = shlex.quote('; '.join(task.command))
         try:
             task.output_file.unlink()
         except Exception:
             pass
-        final_cmd = f"nohup bash -c {cmd} > {task.output_file} 2>&1 &"
+        # the script is sent over stdin, so the commands are not quoted again
+        # for the remote shell; the commands run in the background with the
+        # output redirected, letting the ssh session close right away
+        output_file = shlex.quote(str(task.output_file))
+        script = f"exec > {output_file} 2>&1\n{{\n{task._joined}\n}} < /dev/null &\n"
+        if not self.shared_fs:
+            script = f"mkdir -p \"$(dirname {output_file})\"\n" + script
         task.status = TaskStatus.RUNNING_EARLY
-        self.__send_command(final_cmd, env=os.environ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        self.tasks.append(task)
+        self.__send_command("nohup bash -s", stdin_data=script.encode(), env=os.environ,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with self.__lock:
+            self.tasks.append(task)
+
+
+    def __ssh_options(self) -> list[str]:
+        options = ['-o', 'BatchMode=yes', '-o', f'ConnectTimeout={self.TIMEOUT}']
+        if SSH_MULTIPLEXING:
+            if not Node.__control_dir_created:
+                SSH_CONTROL_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+                Node.__control_dir_created = True
+            options += [
+                '-o', 'ControlMaster=auto',
+                '-o', f'ControlPath={SSH_CONTROL_DIR}/%C',
+                '-o', f'ControlPersist={SSH_CONTROL_PERSIST}',
+            ]
+        return options
+
+
+    def __send_command(self, command: str, stdin_data: bytes | None = None, **popen_kwargs) -> subprocess.Popen:
+        logger.debug("%s (%s): sending command %s", self.name, self.address, command)
+        if stdin_data is not None:
+            popen_kwargs['stdin'] = subprocess.PIPE
+        process = subprocess.Popen(['ssh', *self.__ssh_options(), self.address, command], **popen_kwargs)
+        if stdin_data is not None:
+            assert process.stdin is not None
+            process.stdin.write(stdin_data)
+            process.stdin.close()
+        return process
 
 
-    def __send_command(self, command: str, **popen_kwargs) -> subprocess.Popen:
-        logger.info(f"{self.name} ({self.address}): sending command {command}")
-        process = subprocess.Popen(['ssh', '-o', 'BatchMode=yes', '-o', f'ConnectTimeout={self.TIMEOUT}', self.address, command], **popen_kwargs)
-        return process
+    def nactive(self) -> int:
+        # stalled tasks no longer hold a slot on the node
+        return len(self.__tasks_to_poll())
+
+
+    def free_local_id(self) -> int:
+        # lowest slot on the node not held by an active task
+        used = {task.config.local_id for task in self.__tasks_to_poll()}
+        local_id = 0
+        while local_id in used:
+            local_id += 1
+        return local_id
+
+
+    def __run_in_shell(self, command: str) -> tuple[int, bytes]:
+        # commands go to one long-lived remote bash per node, so repeated polls
+        # neither open a new ssh channel nor start a new shell
+        with self.__lock:
+            if self.__shell is None or self.__shell.poll() is not None:
+                self.__shell = self.__send_command('bash -s', stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            shell = self.__shell
+            assert shell.stdin is not None and shell.stdout is not None
+
+            logger.debug("%s (%s): running %s", self.name, self.address, command)
+            try:
+                shell.stdin.write(command.encode() + b"\necho " + _SHELL_DONE + b" $?\n")
+                shell.stdin.flush()
+            except BrokenPipeError:
+                self.__close_shell()
+                return 255, b""
+
+            output = b""
+            deadline = time.monotonic() + self.TIMEOUT
+            with selectors.DefaultSelector() as selector:
+                selector.register(shell.stdout, selectors.EVENT_READ)
+                while True:
+                    done = (b"\n" + output).rfind(b"\n" + _SHELL_DONE + b" ")
+                    if done != -1 and output.endswith(b"\n"):
+                        return int(output[done + len(_SHELL_DONE):]), output[:done]
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or len(selector.select(remaining)) == 0:
+                        self.__close_shell()
+                        raise TimeoutError(f"{self.name} ({self.address}): no answer within {self.TIMEOUT} s")
+                    chunk = os.read(shell.stdout.fileno(), 65536)
+                    if len(chunk) == 0:
+                        self.__close_shell()
+                        return 255, output
+                    output += chunk
+
+
+    def __close_shell(self):
+        if self.__shell is None:
+            return
+        self.__shell.kill()
+        self.__shell.wait()
+        for pipe in (self.__shell.stdin, self.__shell.stdout):
+            if pipe is not None:
+                pipe.close()
+        self.__shell = None
+
+
+    def close(self):
+        with self.__lock:
+            self.__close_shell()
+        if not SSH_MULTIPLEXING:
+            return
+        logger.info("%s (%s): closing ssh master connection", self.name, self.address)
+        subprocess.run(['ssh', *self.__ssh_options(), '-O', 'exit', self.address],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+    # `existing_files` are the file names per directory known to exist on the
+    # shared filesystem, output files of tasks not yet running are only opened
+    # if listed there
+    def update_and_get_status(self, existing_files: dict[P, set[str]] | None = None) -> NodeStatus:
+        with self.__lock:
+            return self.__update_status(existing_files)
+
+
+    def __update_status(self, existing_files: dict[P, set[str]] | None = None) -> NodeStatus:
+        return self.__status_handlers[self.status](existing_files)
+
+
+    def __status_down(self, existing_files: dict[P, set[str]] | None) -> NodeStatus:
+        return NodeStatus.DOWN
+
+
+    def __status_uninitialised(self, existing_files: dict[P, set[str]] | None) -> NodeStatus:
+        self.status = NodeStatus.CHECKING
+        self.status_process = self.__send_command('nproc', stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        return NodeStatus.CHECKING
+
+
+    def __status_checking(self, existing_files: dict[P, set[str]] | None) -> NodeStatus:
+        assert self.status_process is not None, "Status process should be defined"
+        res = self.status_process.poll()
+        if res is None:
+            return NodeStatus.CHECKING
+        if self.status_process.returncode != 0:
+            self.status = NodeStatus.DOWN
+        else:
+            stdout, _ = self.status_process.communicate()
+            self.nproc = int(stdout)
+            self.status = NodeStatus.UP
+        return self.status
 
 
-    def update_and_get_status(self) -> NodeStatus:
+    def __status_up(self, existing_files: dict[P, set[str]] | None) -> NodeStatus:
+        self.poll_all_tasks(existing_files)
+        return self.status
 
-        match self.status:
 
-            case NodeStatus.DOWN:
-                return NodeStatus.DOWN
-            
-            case NodeStatus.UNINITIALISED:
-                self.status = NodeStatus.CHECKING
-                self.status_process = self.__send_command('nproc', stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                return NodeStatus.CHECKING
+    def poll_all_tasks(self, existing_files: dict[P, set[str]] | None = None):
+        with self.__lock:
+            self.__poll_tasks(self.__tasks_to_poll(), existing_files)
 
-            case NodeStatus.CHECKING:
-                assert self.status_process is not None, "Status process should be defined"
-                res = self.status_process.poll()
-                if res is None:
-                    return NodeStatus.CHECKING
-                if self.status_process.returncode != 0:
-                    self.status = NodeStatus.DOWN
-                else:
-                    stdout, _ = self.status_process.communicate()
-                    self.nproc = int(stdout)
-                    self.status = NodeStatus.UP
-                return self.status
 
-            case NodeStatus.UP:
-                for task in self.tasks:
-                    self.__update_task(task)
-                return NodeStatus.UP
+    def poll_tasks(self, tasks: list[Task]):
+        with self.__lock:
+            if self.status == NodeStatus.UP:
+                self.__poll_tasks([task for task in tasks if task.status in [TaskStatus.RUNNING_EARLY, TaskStatus.RUNNING]])
 
-            case _:
-                raise Exception("unreachable")
 
+    def __poll_tasks(self, tasks: list[Task], existing_files: dict[P, set[str]] | None = None):
 
-    def __update_task(self, task: Task):
+        if len(tasks) == 0:
+            return
 
-        match task.status:
-            case TaskStatus.NOT_STARTED:
-                print("The tasks should have started already...")
-                return task.status
+        if self.shared_fs:
+            # a single stat per task, only changed files are opened and read
+            for task in tasks:
+                if (task.status == TaskStatus.RUNNING_EARLY and existing_files is not None
+                        and task.output_file.name not in existing_files.get(task.output_file.parent, ())):
+                    continue
+                try:
+                    stat = os.stat(task.output_file)
+                except FileNotFoundError:
+                    self.__update_task(task, None)
+                    continue
+                self.__update_task(task, int(stat.st_mtime), stat.st_size)
+            return
+
+        try:
+            returncode, stdout = self.__run_in_shell(self.__poll_script(tasks))
+        except TimeoutError:
+            logger.warning("node (%s, %s) timed out, marking it as down", self.name, self.address)
+            self.status = NodeStatus.DOWN
+            return
+        self.__read_poll_output(tasks, returncode, stdout)
+
+
+    def __tasks_to_poll(self) -> list[Task]:
+        return [task for task in self.tasks if task.status in [TaskStatus.RUNNING_EARLY, TaskStatus.RUNNING]]
+
+
+    def __poll_script(self, tasks: list[Task]) -> str:
+        # one round-trip for all tasks, each file is reported on its own line
+        # as "<mtime> <size> <base64 of the last bytes>", or "-" if it does not exist
+        files = ' '.join(shlex.quote(str(task.output_file)) for task in tasks)
+        return (
+            f'for f in {files}; do '
+            f'if [ -f "$f" ]; then echo "$(stat -c "%Y %s" "$f") $(tail -c {PROGRESS_TAIL_BYTES} "$f" | base64 -w 0)"; '
+            f'else echo -; fi; done'
+        )
+
+
+    def __read_poll_output(self, tasks: list[Task], returncode: int, stdout: bytes):
+        lines = stdout.splitlines()
+        if returncode != 0 or len(lines) != len(tasks):
+            logger.warning("%s (%s): polling tasks failed", self.name, self.address)
+            return
+
+        for task, line in zip(tasks, lines):
+            if line == b'-':
+                self.__update_task(task, None)
+                continue
+            mtime, size, tail = line.split(b' ', 2)
+            self.__update_task(task, int(mtime), int(size), base64.b64decode(tail))
 
-            case TaskStatus.RUNNING_EARLY:
-                if task.output_file.exists():
-                    task.status = TaskStatus.RUNNING
-                    return self.__update_task(task) # should recurse only once
-                return TaskStatus.RUNNING_EARLY
 
-            case TaskStatus.STALLED | TaskStatus.FINISHED:
-                # no further actions done
-                return task.status
+    # `mtime` is None when the output file does not exist yet, with `size` it
+    # tells whether the file changed since it was last read. `tail` is the
+    # end of the output file when polled remotely, otherwise the file is read
+    # from the shared filesystem.
+    def __update_task(self, task: Task, mtime: int | None, size: int = 0, tail: bytes | None = None) -> TaskStatus:
+        return self.__task_handlers[task.status](task, mtime, size, tail)
+
+
+    def __task_not_started(self, task: Task, mtime: int | None, size: int, tail: bytes | None) -> TaskStatus:
+        print("The tasks should have started already...")
+        return task.status
 
-            case TaskStatus.RUNNING:
-                modification_time = int(task.output_file.stat().st_mtime)
-                if modification_time + FILE_MODIFICATION_TIMEOUT <= time.time():
-                    task.status = TaskStatus.STALLED
-                    return task.status
-                elif modification_time == task.last_update:
-                    return task.status
-
-                with open(task.output_file, 'r') as f:
-                    filestr = f.read()
-                progress_instances = re.findall(r"\x02(\d+)/(\d+)\x03", filestr)
-                if len(progress_instances) == 0:
-                    # optimally the user should print 0/N at the very beginning
-                    return TaskStatus.RUNNING
-                
-                progress, total = progress_instances[-1] # consider last progress
-                task.progress, task.total = int(progress), int(total)
-                if task.progress == task.total:
-                    task.status = TaskStatus.FINISHED
+
+    def __task_running_early(self, task: Task, mtime: int | None, size: int, tail: bytes | None) -> TaskStatus:
+        if mtime is not None:
+            task.status = TaskStatus.RUNNING
+            return self.__task_running(task, mtime, size, tail)
+        return TaskStatus.RUNNING_EARLY
+
+
+    def __task_done(self, task: Task, mtime: int | None, size: int, tail: bytes | None) -> TaskStatus:
+        # no further actions done
+        return task.status
+
+
+    def __task_running(self, task: Task, mtime: int | None, size: int, tail: bytes | None) -> TaskStatus:
+        if mtime is None:
+            return task.status
+        if mtime + FILE_MODIFICATION_TIMEOUT <= time.time():
+            task.status = TaskStatus.STALLED
+            return task.status
+        elif (mtime, size) == (task.last_update, task.last_size):
+            return task.status
+        # a write within the same second keeps the mtime but not the size
+        task.last_update, task.last_size = mtime, size
+
+        if tail is not None:
+            last_progress = self.__last_progress(tail)
+        else:
+            try:
+                fd = os.open(task.output_file, os.O_RDONLY)
+            except FileNotFoundError:
                 return task.status
+            try:
+                last_progress = self.__scan_output_file(task, fd)
+            finally:
+                os.close(fd)
+        if last_progress is None:
+            # optimally the user should print 0/N at the very beginning
+            return TaskStatus.RUNNING
+
+        progress, total = last_progress # consider last progress
+        task.progress, task.total = int(progress), int(total)
+        if task.progress == task.total:
+            task.status = TaskStatus.FINISHED
+        return task.status
+
+
+    @staticmethod
+    def __last_progress(buffer: bytes) -> tuple[bytes, bytes] | None:
+        match = None
+        for match in _PROG_RE.finditer(buffer):
+            pass
+        return match.groups() if match is not None else None
+
+
+    def __scan_output_file(self, task: Task, fd: int) -> tuple[bytes, bytes] | None:
+        # scans the unread part of the output file backwards from the end, one
+        # window at a time, so a poll costs the same regardless of the log size
+        size = os.fstat(fd).st_size
+        if size < task.file_offset:
+            task.file_offset = 0 # file was truncated
+        offset = task.file_offset
+        if size == offset:
+            return None
+
+        last_progress, end, head = None, size, b""
+        while last_progress is None and end > offset:
+            start = max(offset, end - PROGRESS_TAIL_BYTES)
+            # pread returns short reads if the file shrinks under us
+            window = os.pread(fd, end - start, start)
+            if end == size:
+                # an unterminated progress token is read again on the next poll
+                token_start = window.rfind(_PROG_START)
+                if token_start != -1 and window.find(_PROG_END, token_start) == -1:
+                    task.file_offset = start + token_start
+                else:
+                    task.file_offset = size
+            # a token may continue into the window scanned before
+            last_progress = self.__last_progress(window + head)
+            end, head = start, window[:PROGRESS_TOKEN_MAX_BYTES]
+        return last_progress
 
-            case _:
-                raise Exception("unreachable")
 
 
+# (ntasks, nnodes, ntasks_per_node) from whichever of them are given (> 0),
+# keyed by which are given; the last argument is Cluster.NODE_TASK_DENSITY
+_PARAM_TABLE: dict[tuple[bool,bool,bool], Callable[[int,int,int,int], tuple[int,int,int]]] = {
+    (True,  False, False): lambda t, n, p, d: (t, int(math.ceil(t / d)), d),
+    (False, True,  False): lambda t, n, p, d: (n, n, 1),
+    (True,  True,  False): lambda t, n, p, d: (t, n, int(math.ceil(t / n))),
+    (False, True,  True):  lambda t, n, p, d: (n * p, n, p),
+    (True,  False, True):  lambda t, n, p, d: (t, int(math.ceil(t / p)), p),
+    # tasks beyond nnodes * ntasks_per_node wait in the ready queue
+    (True,  True,  True):  lambda t, n, p, d: (t, n, p),
+}
+
 
 class Cluster:
 
@@ -226,7 +611,7 @@ class Cluster:
         self,
         job_name: str,
         output_dir: str | P,
-        task_factory: Callable[[NodeTaskConfig],Task],
+        task_factory: Callable[[NodeTaskConfig],Task] | None,
         ntasks = 0,
         nnodes = 0,
         ntasks_per_node = 0,
@@ -234,14 +619,27 @@ class Cluster:
         node_list: list[tuple[str,str]] | None = None, # rename 
         node_file: str | P | None = None,
         restore_nodes: list[Node] | None = None,
+        shared_fs: bool = True,
+        cpus_per_task = 0,
+        pending: list[int] | None = None,
     ) -> None:
         
-        logger.info(f"initialising cluster {job_name=}, {output_dir=}")
+        logger.info("initialising cluster job_name=%r, output_dir=%r", job_name, output_dir)
         self.job_name = job_name
+        self.shared_fs = shared_fs
+        self.cpus_per_task = cpus_per_task
         self.nodes: list[Node] = []
         self.output_dir = P(output_dir).expanduser()
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self.__set_params(ntasks, nnodes, ntasks_per_node)
+        # proc_ids of the tasks not yet assigned to a node
+        if pending is None:
+            # a restored cluster has already assigned the tasks it has
+            pending = [] if restore_nodes is not None else list(range(self.ntasks))
+        self.__ready: deque[int] = deque(pending)
+        self.__task_factory = task_factory
+        self.__last_lines = 0 # height of the last progress block
+        self.__last_records = 0 # log records written before the last block
 
         if nodes is not None:
             pass # nodes = nodes
@@ -255,11 +653,13 @@ class Cluster:
             raise Exception("Nodes must be defined through `nodes`, `node_list`, or `node_file`")
 
         if nodes is not None:
+            for node in nodes:
+                node.shared_fs = shared_fs
             if self.nnodes > len(nodes):
                 raise Exception(f"Not enough nodes provided ({len(nodes)}) for requested number of nodes {self.nnodes}.")
             self.__init_nodes(nodes)
-        if task_factory is not None:
-            self.__assign_tasks_to_nodes(task_factory)
+        self.__assign_ready_tasks()
+        self.__pool = ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_POLLS, len(self.nodes))))
 
 
 
@@ -271,47 +671,89 @@ class Cluster:
             'task_factory': None,
             'ntasks': self.ntasks,
             'nnodes': self.nnodes,
-            'ntasks_per_node': self.ntasks_per_node
+            'ntasks_per_node': self.ntasks_per_node,
+            'shared_fs': self.shared_fs,
+            'cpus_per_task': self.cpus_per_task,
+            'pending': list(self.__ready)
         }
         return data
 
+    # the task factory cannot be saved, it is needed to run the pending tasks
     @classmethod
-    def from_dict(cls, data: dict):
+    def from_dict(cls, data: dict, task_factory: Callable[[NodeTaskConfig],Task] | None = None):
         data['restore_nodes'] = [Node.from_dict(node) for node in data['restore_nodes']]
+        data['task_factory'] = task_factory
         return cls(**data)
     
     def write_to_json(self, filepath: P | str):
-        with open(filepath, 'w') as f:
-            f.write(json.dumps(self.to_dict()))
+        data = self.to_dict()
+        with open(filepath, 'wb') as f:
+            f.write(orjson.dumps(data) if orjson is not None else json.dumps(data).encode())
 
     @classmethod
-    def read_from_json(cls, filepath: P | str):
-        with open(filepath, 'r') as f:
-            json_data = json.load(f)
-        return cls.from_dict(json_data)
+    def read_from_json(cls, filepath: P | str, task_factory: Callable[[NodeTaskConfig],Task] | None = None):
+        with open(filepath, 'rb') as f:
+            json_data = orjson.loads(f.read()) if orjson is not None else json.load(f)
+        return cls.from_dict(json_data, task_factory)
+
+
+    def close(self):
+        self.__pool.shutdown()
+        for node in self.nodes:
+            node.close()
+
 
+    def __node_capacity(self, node: Node) -> int:
+        if self.cpus_per_task > 0:
+            return max(1, node.nproc // self.cpus_per_task)
+        return self.ntasks_per_node
 
-    def __assign_tasks_to_nodes(self, func: Callable[[NodeTaskConfig],Task]):
 
-        local_id, node_id, proc_id = 0, 0, 0
-        for node_id in range(self.nnodes):
-            selected_node: Node = self.nodes[node_id]
-            for local_id in range(self.ntasks_per_node):
-                proc_id = node_id * self.ntasks_per_node + local_id
+    def __assign_ready_tasks(self):
+        # every node takes tasks from the shared ready queue while it has free
+        # slots, so nodes that finish early or have more cpus run more tasks
+        if self.__task_factory is None:
+            return
+        for node_id, selected_node in enumerate(self.nodes):
+            if selected_node.status != NodeStatus.UP:
+                continue
+            free_slots = self.__node_capacity(selected_node) - selected_node.nactive()
+            while free_slots > 0 and len(self.__ready) > 0:
+                proc_id = self.__ready.popleft()
                 conf = NodeTaskConfig(
                     cpus_on_node=selected_node.nproc, node_name=selected_node.name,
-                    local_id=local_id, node_id=node_id, proc_id=proc_id, output_dir=self.output_dir,
+                    local_id=selected_node.free_local_id(), node_id=node_id, proc_id=proc_id, output_dir=self.output_dir,
                     job_name=self.job_name)
-                task = func(conf)
+                task = self.__task_factory(conf)
                 selected_node.assign_task(task)
+                free_slots -= 1
     
 
     def update_node_statuses(self):
-        for node in self.nodes:
-            node.update_and_get_status()
-            for task in node.tasks:
-                if task.status in [TaskStatus.FINISHED, TaskStatus.STALLED]:
-                    continue
+        # wall time of a poll is the slowest node instead of the sum over nodes
+        existing_files = self.__list_early_output_files() if self.shared_fs else None
+        list(self.__pool.map(lambda node: node.update_and_get_status(existing_files), self.nodes))
+        self.__assign_ready_tasks()
+
+
+    def __list_early_output_files(self) -> dict[P, set[str]] | None:
+        # one directory listing per output directory instead of a lookup per
+        # task that has not started writing its output yet
+        directories = {
+            task.output_file.parent
+            for node in self.nodes for task in node.tasks
+            if task.status == TaskStatus.RUNNING_EARLY
+        }
+        if len(directories) == 0:
+            return None
+        existing_files: dict[P, set[str]] = {}
+        for directory in directories:
+            try:
+                with os.scandir(directory) as entries:
+                    existing_files[directory] = {entry.name for entry in entries}
+            except FileNotFoundError:
+                pass
+        return existing_files
 
 
     def __set_params(self, ntasks = 0, nnodes = 0, ntasks_per_node = 0):
@@ -320,41 +762,17 @@ class Cluster:
         has_nodes = nnodes > 0
         has_ntasks_per_node = ntasks_per_node > 0
 
-        match (has_ntasks, has_nodes, has_ntasks_per_node):
-            case (True, False, False):
-                self.ntasks = ntasks
-                self.nnodes = int(math.ceil(ntasks / self.NODE_TASK_DENSITY))
-                self.ntasks_per_node = self.NODE_TASK_DENSITY
-            case (False, True, False):
-                self.ntasks = nnodes
-                self.nnodes = nnodes
-                self.ntasks_per_node = 1
-            case (True, True, False):
-                self.ntasks = ntasks
-                self.nnodes = nnodes
-                self.ntasks_per_node = int(math.ceil(ntasks / nnodes))
-            case (False, True, True):
-                self.ntasks = nnodes * ntasks_per_node
-                self.nnodes = nnodes
-                self.ntasks_per_node = ntasks_per_node
-            case (True, False, True):
-                self.ntasks = ntasks
-                self.nnodes = int(math.ceil(ntasks / ntasks_per_node))
-                self.ntasks_per_node = ntasks_per_node
-            case (True, True, True):
-                if ntasks > (nnodes * ntasks_per_node):
-                    raise Exception(f"Invalid parameter configuration: {ntasks=}, {nnodes=}, {ntasks_per_node=}")
-                self.ntasks = ntasks
-                self.nnodes = nnodes
-                self.ntasks_per_node = ntasks_per_node
-            case _:
-                raise Exception(f"Invalid parameter configuration: {ntasks=}, {nnodes=}, {ntasks_per_node=}")
-        logger.info(f"setting parameters: {self.ntasks=}, {self.nnodes=}, {self.ntasks_per_node=}")
+        try:
+            resolve = _PARAM_TABLE[(has_ntasks, has_nodes, has_ntasks_per_node)]
+        except KeyError:
+            raise Exception(f"Invalid parameter configuration: {ntasks=}, {nnodes=}, {ntasks_per_node=}") from None
+        self.ntasks, self.nnodes, self.ntasks_per_node = resolve(ntasks, nnodes, ntasks_per_node, self.NODE_TASK_DENSITY)
+        logger.info("setting parameters: self.ntasks=%d, self.nnodes=%d, self.ntasks_per_node=%d", self.ntasks, self.nnodes, self.ntasks_per_node)
 
 
     def __read_nodes_from_file(self, filepath: P) -> list[Node]:
 
-        logger.info(f"reading nodes from file {filepath}")
+        logger.info("reading nodes from file %s", filepath)
         with open(filepath, 'r') as f:
             lines = f.readlines()
         nodes = []
@@ -364,11 +782,11 @@ class Cluster:
                 continue
             split_line = line.split(':')
             if len(split_line) != 2:
-                logger.info(f"    not read: {line}")
+                logger.info("    not read: %s", line)
                 continue
             name, address = split_line
             name, address = name.strip(), address.strip()
-            logger.info(f"        read: {name=}, {address=}")
+            logger.info("        read: name=%r, address=%r", name, address)
             nodes.append(Node(name, address))
         return nodes
 
@@ -376,23 +794,46 @@ class Cluster:
     def __init_nodes(self, nodes: list[Node]) -> int:
 
         logger.info("initialising nodes") 
-        nodes_to_check = nodes[:self.nnodes]
-        chunk = 0
-        while len(nodes_to_check) > 0 and len(self.nodes) != self.nnodes:
-            node = nodes_to_check.pop(0)
-            node_status = node.update_and_get_status()
+        nodes_to_check = list(nodes)
+        # `nproc` probes of the nodes being checked, a node is handled as soon
+        # as its probe answers so a slow node does not hold up the others
+        selector = selectors.DefaultSelector()
+
+        def handle(node: Node, node_status: NodeStatus):
             match node_status:
                 case NodeStatus.DOWN:
-                    logger.warning(f"node ({node.name}, {node.address}) is down")
-                    continue
+                    logger.warning("node (%s, %s) is down", node.name, node.address)
                 case NodeStatus.CHECKING:
-                    nodes_to_check.append(node)
+                    assert node.status_process is not None and node.status_process.stdout is not None
+                    selector.register(node.status_process.stdout, selectors.EVENT_READ, node)
                 case NodeStatus.UP:
-                    logger.info(f"node ({node.name}, {node.address}) is up")
+                    logger.info("node (%s, %s) is up", node.name, node.address)
                     self.nodes.append(node)
-            if len(nodes_to_check) == 0:
-                chunk += 1
-                nodes_to_check = nodes[(chunk*self.nnodes):((chunk+1)*self.nnodes)]
+
+        while len(self.nodes) != self.nnodes:
+            # keep as many probes in flight as there are nodes missing
+            while len(nodes_to_check) > 0 and len(self.nodes) + len(selector.get_map()) < self.nnodes:
+                node = nodes_to_check.pop(0)
+                handle(node, node.update_and_get_status())
+            if len(selector.get_map()) == 0:
+                break
+
+            events = selector.select(timeout=2 * GLOBAL_TIMEOUT)
+            if len(events) == 0:
+                for key in list(selector.get_map().values()):
+                    node = key.data
+                    selector.unregister(key.fileobj)
+                    node.status_process.kill()
+                    node.status_process.wait()
+                    handle(node, node.update_and_get_status())
+                continue
+            for key, _ in events:
+                # output or EOF has arrived, the probe is about to exit
+                node = key.data
+                selector.unregister(key.fileobj)
+                node.status_process.wait()
+                handle(node, node.update_and_get_status())
+        selector.close()
 
         if len(self.nodes) < self.nnodes:
             raise Exception(f"too few nodes available for the number of requested nodes ({len(self.nodes)} < {self.nnodes})")
@@ -400,15 +841,81 @@ class Cluster:
         return len(self.nodes) 
 
 
-    def print_progress(self):
-        lines_printed = 0
+    @property
+    def status(self) -> ClusterStatus:
+        if len(self.nodes) == 0:
+            return ClusterStatus.UNINITIALISED
+        # tasks on nodes that went down are not waited for
+        for node in self.nodes:
+            if node.status == NodeStatus.DOWN:
+                continue
+            if node.nactive() > 0 or (len(self.__ready) > 0 and self.__task_factory is not None):
+                return ClusterStatus.RUNNING
+        return ClusterStatus.FINISHED
+
+
+    def watch(self, interval: float = WATCH_INTERVAL):
+        # prints the progress until all tasks are done. On a shared filesystem
+        # under linux the tasks whose output changed are updated as soon as
+        # inotify reports it; a full poll still runs every `interval` seconds,
+        # events or not, to catch stalled tasks, missed events and freed slots.
+        inotify = _Inotify.create() if self.shared_fs else None
+        try:
+            self.print_progress()
+            last_full_poll = time.monotonic()
+            while self.status == ClusterStatus.RUNNING:
+                if inotify is None:
+                    time.sleep(interval)
+                    self.print_progress()
+                    continue
+
+                # inotify reports absolute paths, the output files may be relative
+                tasks_by_file = {
+                    os.path.abspath(task.output_file): (node, task)
+                    for node in self.nodes for task in node.tasks
+                }
+                for output_file in tasks_by_file:
+                    inotify.add_watch(P(output_file).parent)
+                changed = inotify.wait(max(0, last_full_poll + interval - time.monotonic()))
+                if time.monotonic() - last_full_poll >= interval:
+                    self.print_progress()
+                    last_full_poll = time.monotonic()
+                    continue
+                if len(changed) == 0:
+                    continue
 
+                changed_tasks: dict[Node, list[Task]] = {}
+                for output_file in changed & tasks_by_file.keys():
+                    node, task = tasks_by_file[output_file]
+                    changed_tasks.setdefault(node, []).append(task)
+                list(self.__pool.map(lambda item: item[0].poll_tasks(item[1]), changed_tasks.items()))
+                self.__assign_ready_tasks()
+                self.__write_progress()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+
+    def print_progress(self):
         self.update_node_statuses()
+        self.__write_progress()
+
+
+    def __write_progress(self):
+        lines = []
         for node_id, node in enumerate(self.nodes):
-            print(f"Node: {node.name} | {node.status} | {node_id=}")
-            lines_printed += 1
+            lines.append(f"Node: {node.name} | {node.status} | {node_id=}")
             for task in node.tasks:
-                print(f"    Task: {task.status}, local_id={task.config.local_id}, proc_id={task.config.proc_id}, progress: {task.progress}/{task.total}")
-                lines_printed += 1
-            lines_printed = 0 # can be replaced with multiplication
-        print("")
+                lines.append(f"    Task: {task.status}, local_id={task.config.local_id}, proc_id={task.config.proc_id}, progress: {task.progress}/{task.total}")
+        lines.append("")
+
+        # on a terminal the previous block is overwritten instead of scrolled
+        # away, unless log messages were printed after it, and the whole block
+        # goes out in a single write
+        redraw = ""
+        if self.__last_lines > 0 and self.__last_records == _stdout_records.count and sys.stdout.isatty():
+            redraw = f"\x1b[{self.__last_lines}A\x1b[J"
+        sys.stdout.write(redraw + "\n".join(lines) + "\n")
+        sys.stdout.flush()
+        self.__last_lines = len(lines)
+        self.__last_records = _stdout_records.count
@@ -1,4 +1,3 @@
-import time
 import sys
 from pathlib import Path
 sys.path.append('../final')
@@ -23,6 +22,5 @@ clust = Cluster(
     node_file       = "example/hostfile.txt"
 )
 
-while True:
-    clust.print_progress()
-    time.sleep(5)
+clust.watch()
+clust.close()